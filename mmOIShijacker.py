@@ -1,16 +1,27 @@
 # mmOIShijacker.py (Revised "Back-to-Basics" Version)
 
 import asyncio
+import contextlib
 import json
+import logging
+from itertools import islice
+import math
+import random
 import os
-import boto3
-from datetime import datetime, timezone
-import decimal
+import sys
+import time
+from urllib.parse import urlsplit
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from http.cookies import CookieError, SimpleCookie
+import aiohttp
+from aiohttp import compression_utils
+import ijson
+import numpy as np
 
-# Use cloudscraper that has been patched by playwright_stealth
+# Playwright (patched by playwright_stealth) is only used to harvest credentials; the API itself is called with aiohttp
 from playwright.async_api import async_playwright
-from playwright_stealth import stealth_async
-import cloudscraper
+from playwright_stealth import StealthConfig, stealth_async
 
 # --- Configuration (Pulled from Environment Variables) ---
 DYNAMODB_TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME', 'MM_OIS')
@@ -20,135 +31,513 @@ METRIC_IDS_STR = os.environ.get(
     'MacroMicro_OIS_1M_Rate,MacroMicro_OIS_3M_Rate,MacroMicro_OIS_6M_Rate,MacroMicro_OIS_1Y_Rate,MacroMicro_OIS_2Y_Rate,MacroMicro_OIS_10Y_Rate,MacroMicro_OIS_30Y_Rate'
 )
 METRIC_IDS = METRIC_IDS_STR.split(',')
+RUN_INTERVAL_SECONDS = int(os.environ.get('RUN_INTERVAL_SECONDS', '3600'))
+CREDENTIALS_MAX_AGE_SECONDS = int(os.environ.get('CREDENTIALS_MAX_AGE_SECONDS', '21600'))
+# Harvested credentials are cached here between runs; set CREDENTIALS_SSM_PARAMETER to share them across tasks instead
+CREDENTIALS_FILE = os.environ.get('CREDENTIALS_FILE', '/tmp/mm_creds.json')
+CREDENTIALS_SSM_PARAMETER = os.environ.get('CREDENTIALS_SSM_PARAMETER')
+# FULL_REFRESH=1 rewrites every processed point instead of only the latest stored day and anything newer
+FULL_REFRESH = os.environ.get('FULL_REFRESH', '0') == '1'
 
-# Initialize Boto3 DynamoDB resource
-dynamodb = boto3.resource('dynamodb', region_name=AWS_TARGET_REGION)
-table = dynamodb.Table(DYNAMODB_TABLE_NAME)
+log = logging.getLogger(__name__)
 
-def process_and_store_data(api_data):
-    """Parses the JSON data from the API, takes the last 30 data points for each series, formats them, and stores them in DynamoDB."""
-    print("\n--- Stage 3: Processing and Storing Data in DynamoDB ---")
-    
-    try:
-        list_of_series_data = api_data['data']['c:115044']['series']
-    except (KeyError, TypeError):
-        print("  ERROR: The 'series' data was not found in the expected JSON path.")
-        print("  Response JSON (partial):", json.dumps(api_data, indent=2)[:1000])
+CHART_PAGE_URL = "https://en.macromicro.me/charts/115044/us-overnight-indexed-swaps"
+DATA_API_URL = "https://en.macromicro.me/charts/data/115044"
+API_HOST = urlsplit(DATA_API_URL).hostname
+# ijson prefix of each series list: {"data": {"c:115044": {"series": [[[date, value], ...], ...]}}}
+SERIES_JSON_PREFIX = 'data.c:115044.series.item'
+# Only advertise zstd when this aiohttp can decode it; otherwise the compressed body would reach ijson undecoded
+AIOHTTP_HAS_ZSTD = getattr(compression_utils, 'HAS_ZSTD', False)
+BROWSER_PROFILE_DIR = os.environ.get('BROWSER_PROFILE_DIR', '/opt/profile')
+# The Chrome-only patches would give a Firefox page a window.chrome object and a Google navigator.vendor
+STEALTH_CONFIG = StealthConfig(
+    chrome_app=False, chrome_csi=False, chrome_load_times=False, chrome_runtime=False,
+    hairline=False, navigator_vendor=False
+)
+
+# aiobotocore session; the DynamoDB (and SSM) clients are opened where they are needed
+session = get_session()
+MAX_BATCH_WRITE_SIZE = 25  # BatchWriteItem hard limit
+MAX_BATCH_WRITE_ATTEMPTS = 8
+MAX_IN_FLIGHT_BATCHES = int(os.environ.get('MAX_IN_FLIGHT_BATCHES', '8'))
+# Keep the connection pool well above the in-flight limit so batches never wait on a connection
+DYNAMODB_CLIENT_CONFIG = AioConfig(max_pool_connections=32)
+
+MS_PER_DAY = 86_400_000
+_DAYS_IN_MONTH = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31], dtype=np.int64)
+_DIGIT_COLUMNS = [0, 1, 2, 3, 5, 6, 8, 9]  # positions of the digits in "YYYY-MM-DD"
+
+def _dates_to_epoch_ms(dates):
+    """Converts a list of "YYYY-MM-DD" strings to epoch milliseconds (UTC) in one vectorised NumPy pass.
+    The digits are read straight from the bytes and turned into a day count with the days-from-civil
+    formula (Howard Hinnant), so no per-date string parsing happens. Dates that are not well-formed come back as None."""
+    raw = np.array([d.encode('ascii', 'replace') if isinstance(d, str) and len(d) == 10 else b'' for d in dates], dtype='S10')
+    digits = raw.view(np.uint8).reshape(-1, 10).astype(np.int64) - ord('0')
+
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 5] * 10 + digits[:, 6]
+    day = digits[:, 8] * 10 + digits[:, 9]
+
+    is_leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_length = _DAYS_IN_MONTH[np.clip(month, 1, 12) - 1] + (is_leap & (month == 2))
+    valid = (
+        ((digits[:, _DIGIT_COLUMNS] >= 0) & (digits[:, _DIGIT_COLUMNS] <= 9)).all(axis=1)
+        & (digits[:, 4] == ord('-') - ord('0')) & (digits[:, 7] == ord('-') - ord('0'))
+        & (month >= 1) & (month <= 12) & (day >= 1) & (day <= month_length)
+    )
+
+    # days_from_civil: shift the year to start in March so the leap day is the last day of the year
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    days = era * 146097 + day_of_era - 719468
+
+    timestamps = (days * MS_PER_DAY).tolist()
+    return [ts if ok else None for ts, ok in zip(timestamps, valid.tolist())]
+
+
+def _number_attr(value):
+    """Builds the DynamoDB 'N' attribute for a point value directly, without going through Decimal and TypeSerializer."""
+    if isinstance(value, bool):
+        raise TypeError(f"not a number: {value!r}")
+    if isinstance(value, int):
+        return {'N': str(value)}
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f"DynamoDB cannot store {value!r}")
+    return {'N': repr(number)}
+
+
+async def _latest_ts(client, metric_id):
+    """Returns the newest timestamp already stored for a metric, or None if it has no items yet."""
+    response = await client.query(
+        TableName=DYNAMODB_TABLE_NAME,
+        KeyConditionExpression='metricId = :m',
+        ExpressionAttributeValues={':m': {'S': metric_id}},
+        ScanIndexForward=False,
+        Limit=1,
+        ProjectionExpression='#t',
+        ExpressionAttributeNames={'#t': 'timestamp'}
+    )
+    items = response.get('Items')
+    return int(items[0]['timestamp']['N']) if items else None
+
+
+async def _batch_write(client, in_flight, put_requests):
+    """Sends up to 25 PutRequests with one BatchWriteItem call, retrying UnprocessedItems with jittered exponential backoff.
+    `in_flight` is the semaphore bounding concurrent calls; it is not held while backing off."""
+    request_items = {DYNAMODB_TABLE_NAME: put_requests}
+    for attempt in range(MAX_BATCH_WRITE_ATTEMPTS):
+        if attempt:
+            await asyncio.sleep(min(1.0, 0.05 * 2 ** attempt) + random.random() * 0.05)
+        async with in_flight:
+            response = await client.batch_write_item(RequestItems=request_items)
+        request_items = response.get('UnprocessedItems')
+        if not request_items:
+            return
+    raise RuntimeError(f"{len(request_items[DYNAMODB_TABLE_NAME])} items still unprocessed after {MAX_BATCH_WRITE_ATTEMPTS} attempts")
+
+
+async def _write_series(client, in_flight, current_metric_id, last_3_points, total_points):
+    """Formats the last 3 points of one series (projected out by process_and_store_data) and writes the ones from
+    the latest stored day onwards in BatchWriteItem chunks of 25, sent concurrently. Returns (items written, items skipped as already stored)."""
+    log.info("  Processing metric: %s - found %d total points, processing the last %d.", current_metric_id, total_points, len(last_3_points))
+
+    last_ts = None
+    if not FULL_REFRESH:
+        try:
+            last_ts = await _latest_ts(client, current_metric_id)
+        except Exception as e:
+            # e.g. a task role without dynamodb:Query; writing every point is slower but still correct
+            log.warning("    - [%s] Could not look up the latest stored point (%s: %s), writing all points.", current_metric_id, type(e).__name__, e)
+
+    entries, dates, values = [], [], []
+    for log_entry in last_3_points:
+        try:
+            date_str, value = log_entry[0], log_entry[1]
+        except (TypeError, IndexError, KeyError) as e:
+            log.debug("    - [%s] Skipping malformed data point: %s. Error: %s", current_metric_id, log_entry, e)
+            continue
+        if value is None:
+            continue
+        entries.append(log_entry)
+        dates.append(date_str)
+        values.append(value)
+
+    metric_attr = {'S': current_metric_id}
+    put_requests = []
+    points_skipped_for_metric = 0
+    for log_entry, timestamp_ms, value in zip(entries, _dates_to_epoch_ms(dates), values):
+        if timestamp_ms is None:
+            log.debug("    - [%s] Skipping malformed data point: %s. Error: unparseable date", current_metric_id, log_entry)
+            continue
+        # The newest stored day is rewritten on purpose: its value may still be revised (e.g. intraday updates)
+        if last_ts is not None and timestamp_ms < last_ts:
+            points_skipped_for_metric += 1
+            continue
+        try:
+            value_attr = _number_attr(value)
+        except (ValueError, TypeError) as e:
+            log.debug("    - [%s] Skipping malformed data point: %s. Error: %s", current_metric_id, log_entry, e)
+            continue
+
+        put_requests.append({'PutRequest': {'Item': {
+            'metricId': metric_attr,
+            'timestamp': {'N': str(timestamp_ms)},
+            'value': value_attr
+        }}})
+
+    batch_writes = []
+    remaining = iter(put_requests)
+    while chunk := list(islice(remaining, MAX_BATCH_WRITE_SIZE)):
+        batch_writes.append(_batch_write(client, in_flight, chunk))
+    await asyncio.gather(*batch_writes)
+
+    return len(put_requests), points_skipped_for_metric
+
+
+async def process_and_store_data(series_stream):
+    """Consumes the series from the API as they are decoded, takes the last 3 data points for each, formats them, and stores them in DynamoDB.
+    Each series starts writing as soon as it has been parsed, so parsing overlaps with the DynamoDB calls; at most
+    MAX_IN_FLIGHT_BATCHES BatchWriteItem calls are in flight on the shared low-level client."""
+    log.info("--- Stage 3: Processing and Storing Data in DynamoDB ---")
+
+    in_flight = asyncio.Semaphore(MAX_IN_FLIGHT_BATCHES)
+    async with session.create_client('dynamodb', region_name=AWS_TARGET_REGION, config=DYNAMODB_CLIENT_CONFIG) as client:
+        writers = []
+        series_count = 0
+        try:
+            async for series_raw_data in series_stream:
+                # Extra series without a metric ID are counted for the warning below but not stored
+                if series_count < len(METRIC_IDS):
+                    # Only the tail is handed on, so the full history is freed before the next series is decoded
+                    # rather than living on in a writer task that may still be waiting on DynamoDB
+                    writers.append(asyncio.create_task(_write_series(
+                        client, in_flight, METRIC_IDS[series_count], series_raw_data[-3:], len(series_raw_data)
+                    )))
+                del series_raw_data
+                series_count += 1
+            counts = await asyncio.gather(*writers)
+        except BaseException:
+            for writer in writers:
+                writer.cancel()
+            raise
+
+    if series_count == 0:
+        log.error("  ERROR: The 'series' data was not found in the expected JSON path.")
         return
+    if series_count != len(METRIC_IDS):
+        log.warning("  WARNING: Mismatch! Received %d data series, but have %d metric IDs configured.", series_count, len(METRIC_IDS))
 
-    if len(list_of_series_data) != len(METRIC_IDS):
-        print(f"  WARNING: Mismatch! Received {len(list_of_series_data)} data series, but have {len(METRIC_IDS)} metric IDs configured.")
+    total_items_written = sum(written for written, _ in counts)
+    total_items_skipped = sum(skipped for _, skipped in counts)
+    log.info("  ✓ DynamoDB batch writing complete. Total items written: %d (%d already stored).", total_items_written, total_items_skipped)
 
-    total_items_written = 0
-    with table.batch_writer() as batch:
-        for i, series_raw_data in enumerate(list_of_series_data):
-            if i >= len(METRIC_IDS):
-                break
 
-            current_metric_id = METRIC_IDS[i]
-            print(f"  Processing metric: {current_metric_id}")
+async def launch_browser(playwright):
+    """Launches Firefox on the persistent profile (pre-warmed in the Docker image) and returns (context, page).
+    The stealth patches are injected into the page here, once; every later harvest reuses the same page."""
+    context = await playwright.firefox.launch_persistent_context(BROWSER_PROFILE_DIR, headless=True)
+    page = context.pages[0]
+    await stealth_async(page, STEALTH_CONFIG)
+    return context, page
 
-            last_3_points = series_raw_data[-3:]
-            print(f"    - Found {len(series_raw_data)} total points, processing the last {len(last_3_points)}.")
-            
-            points_processed_for_metric = 0
-            for log_entry in last_3_points:
-                try:
-                    date_str, value = log_entry[0], log_entry[1]
-                    if value is None:
-                        continue
-
-                    dt_object = datetime.strptime(date_str, "%Y-%m-%d").replace(tzinfo=timezone.utc)
-                    timestamp_ms = int(dt_object.timestamp() * 1000)
-                    value_decimal = decimal.Decimal(str(value))
-
-                    item_to_store = {
-                        'metricId': current_metric_id,
-                        'timestamp': timestamp_ms,
-                        'value': value_decimal
-                    }
-                    
-                    batch.put_item(Item=item_to_store)
-                    points_processed_for_metric += 1
-                except (ValueError, TypeError, IndexError) as e:
-                    print(f"    - Skipping malformed data point: {log_entry}. Error: {e}")
-            
-            print(f"    Queued {points_processed_for_metric} data points for storage.")
-            total_items_written += points_processed_for_metric
-    print(f"\n  ✓ DynamoDB batch writing complete. Total items written: {total_items_written}")
 
+async def harvest_credentials(page):
+    """(Re)loads the chart page in the given, already stealth-patched page and harvests the bearer token, cookies and
+    the browser's own User-Agent (so the API calls present exactly the Firefox build Playwright ships).
+    The token is read from the Authorization header of the page's own data XHR as soon as it is sent,
+    falling back to polling App.stk if that request is not seen in time."""
+    token_future = asyncio.get_running_loop().create_future()
 
-async def main():
-    """Main execution flow, sticking closer to the original logic."""
-    print("Starting MacroMicro OIS Hijacker Script (Revised)...")
+    async def on_request(request):
+        if token_future.done() or not request.url.startswith(DATA_API_URL):
+            return
+        authorization = await request.header_value('authorization')
+        if authorization and not token_future.done():
+            token_future.set_result(authorization)
+
+    page.on("request", on_request)
+    try:
+        log.info("  Navigating to the chart page...")
+        await page.goto(CHART_PAGE_URL, wait_until="commit", timeout=60000)
+
+        log.info("  Waiting for the chart data request...")
+        try:
+            bearer_token = (await asyncio.wait_for(token_future, 15)).removeprefix('Bearer ')
+        except asyncio.TimeoutError:
+            log.info("  Data request not seen, waiting for application state (App.stk)...")
+            await page.wait_for_function("() => typeof window.App !== 'undefined' && typeof window.App.stk === 'string'", timeout=30000)
+            bearer_token = await page.evaluate("() => window.App.stk")
+
+        cookies = await page.context.cookies()
+        user_agent = await page.evaluate("() => navigator.userAgent")
+    finally:
+        page.remove_listener("request", on_request)
+
+    if not bearer_token or not cookies:
+        raise Exception("Failed to harvest a bearer token or cookies.")
+
+    log.info("  ✓ Credentials Harvested Successfully!")
+    return bearer_token, cookies, user_agent
+
+
+def open_api_session(bearer_token, cookies, user_agent):
+    """Creates an aiohttp session that replays the harvested cookies and headers, so Cloudflare sees the same client as the browser."""
+    # quote_cookie=False sends the values exactly as the browser did instead of re-quoting non-token characters
+    jar = aiohttp.CookieJar(quote_cookie=False)
+    for cookie in cookies:
+        # The browser context also holds third-party cookies; only the ones the API host would receive are replayed
+        domain = cookie.get('domain', '').lstrip('.')
+        if domain and API_HOST != domain and not API_HOST.endswith('.' + domain):
+            continue
+        morsel = SimpleCookie()
+        try:
+            morsel[cookie['name']] = cookie['value']
+        except CookieError as e:
+            log.debug("  Skipping cookie %r that aiohttp cannot replay: %s", cookie['name'], e)
+            continue
+        morsel[cookie['name']]['domain'] = cookie.get('domain', '')
+        morsel[cookie['name']]['path'] = cookie.get('path', '/')
+        jar.update_cookies(morsel)
 
-    chart_page_url = "https://en.macromicro.me/charts/115044/us-overnight-indexed-swaps"
-    data_api_url = "https://en.macromicro.me/charts/data/115044"
-    user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.0.0 Safari/537.36"
+    headers = {
+        'Accept': '*/*',
+        # zstd decodes faster than gzip/br and is smaller on the wire; aiohttp decodes it in-stream, gzip stays as the fallback
+        'Accept-Encoding': 'zstd, gzip' if AIOHTTP_HAS_ZSTD else 'gzip',
+        'Authorization': f'Bearer {bearer_token}',
+        'Referer': CHART_PAGE_URL,
+        'User-Agent': user_agent
+    }
+    return aiohttp.ClientSession(cookie_jar=jar, headers=headers, timeout=aiohttp.ClientTimeout(total=30))
+
+
+@contextlib.asynccontextmanager
+async def fetch_data_with_credentials(api_session):
+    """Calls the data API directly through the credentialed session and yields an async iterator over the series,
+    decoded incrementally from the response stream so the whole document is never held in memory."""
+    log.info("  Sending GET request to: %s", DATA_API_URL)
+    async with api_session.get(DATA_API_URL) as response:
+        if response.status >= 400:
+            body = await response.read()
+            log.error("  Server response text: %s", body[:500].decode(errors='ignore'))
+        response.raise_for_status()
+        log.info("  ✓ API Call Success! Server responded with Status Code: %d", response.status)
+        yield ijson.items_async(response.content, SERIES_JSON_PREFIX, use_float=True)
+
+
+def _is_auth_error(error):
+    """True if the API rejected the harvested credentials (expired token or cookies)."""
+    return isinstance(error, aiohttp.ClientResponseError) and error.status in (401, 403)
+
+
+def _credentials_expiry(cookies):
+    """Epoch seconds until which harvested credentials are reused: CREDENTIALS_MAX_AGE_SECONDS from now,
+    or earlier if the Cloudflare clearance cookie runs out first."""
+    expires_at = time.time() + CREDENTIALS_MAX_AGE_SECONDS
+    for cookie in cookies:
+        if cookie['name'] == 'cf_clearance' and cookie.get('expires', -1) != -1:
+            expires_at = min(expires_at, cookie['expires'])
+    return expires_at
+
+
+async def load_cached_credentials():
+    """Returns (bearer_token, cookies, user_agent, expires_at) from the credentials cache (SSM parameter if
+    CREDENTIALS_SSM_PARAMETER is set, else CREDENTIALS_FILE), or None if there is nothing valid cached."""
+    try:
+        if CREDENTIALS_SSM_PARAMETER:
+            async with session.create_client('ssm', region_name=AWS_TARGET_REGION) as ssm:
+                response = await ssm.get_parameter(Name=CREDENTIALS_SSM_PARAMETER, WithDecryption=True)
+            cached = json.loads(response['Parameter']['Value'])
+        else:
+            if not os.path.exists(CREDENTIALS_FILE):
+                return None
+            with open(CREDENTIALS_FILE) as f:
+                cached = json.load(f)
+
+        if not (
+            isinstance(cached, dict)
+            and isinstance(cached.get('token'), str)
+            and isinstance(cached.get('user_agent'), str)
+            and isinstance(cached.get('cookies'), list)
+            and all(isinstance(c, dict) and isinstance(c.get('name'), str) and isinstance(c.get('value'), str) for c in cached['cookies'])
+            and isinstance(cached.get('expires_at'), (int, float))
+            and not isinstance(cached['expires_at'], bool)
+        ):
+            raise ValueError("cached credentials do not have the expected {token, user_agent, cookies, expires_at} shape")
+    except Exception as e:
+        # ParameterNotFound on first run, unreadable or malformed cache, ...: just harvest fresh credentials
+        log.info("  No usable cached credentials (%s: %s).", type(e).__name__, e)
+        return None
+
+    if time.time() >= cached['expires_at']:
+        log.info("  Cached credentials have expired.")
+        return None
+    return cached['token'], cached['cookies'], cached['user_agent'], cached['expires_at']
+
+
+async def save_cached_credentials(bearer_token, cookies, user_agent, expires_at):
+    """Stores freshly harvested credentials in the credentials cache. Failures are logged, never raised."""
+    payload = json.dumps({'token': bearer_token, 'cookies': cookies, 'user_agent': user_agent, 'expires_at': expires_at})
+    try:
+        if CREDENTIALS_SSM_PARAMETER:
+            async with session.create_client('ssm', region_name=AWS_TARGET_REGION) as ssm:
+                # Intelligent-Tiering moves to the advanced tier on its own if the cookie jar exceeds 4 KB
+                await ssm.put_parameter(
+                    Name=CREDENTIALS_SSM_PARAMETER, Value=payload, Type='SecureString',
+                    Overwrite=True, Tier='Intelligent-Tiering'
+                )
+        else:
+            # Write-then-rename so a concurrent reader never sees a half-written file; the token is private
+            tmp_path = f"{CREDENTIALS_FILE}.tmp"
+            with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                f.write(payload)
+            os.replace(tmp_path, CREDENTIALS_FILE)
+    except Exception as e:
+        log.warning("  Could not cache credentials (%s: %s).", type(e).__name__, e)
+
+
+async def _fetch_and_store(bearer_token, cookies, user_agent):
+    """Stages 2 and 3 for the one-shot flow: one API session, one streamed response, one DynamoDB pass."""
+    log.info("--- Stage 2: Making Direct API Call with aiohttp ---")
+    async with open_api_session(bearer_token, cookies, user_agent) as api_session:
+        async with fetch_data_with_credentials(api_session) as series_stream:
+            # --- PART 3: Process and Store Data (while the response is still streaming) ---
+            await process_and_store_data(series_stream)
+
+
+async def main():
+    """One-shot execution flow: reuse cached credentials if they are still valid (harvesting new ones only if
+    there are none or the API rejects them), fetch the data and store it, then exit."""
+    log.info("Starting MacroMicro OIS Hijacker Script (Revised)...")
 
     playwright = None # Define here to ensure it's available in finally block
+    browser_closing = None
     try:
-        print("--- Stage 1: Initializing Playwright and Harvesting Credentials ---")
+        cached = await load_cached_credentials()
+        if cached is not None:
+            log.info("--- Stage 1: Reusing Cached Credentials ---")
+            bearer_token, cookies, user_agent, _ = cached
+            try:
+                await _fetch_and_store(bearer_token, cookies, user_agent)
+                log.info("Script finished successfully.")
+                return
+            except Exception as e:
+                if not _is_auth_error(e):
+                    raise
+                log.warning("  Cached credentials rejected, harvesting new ones...")
+
+        log.info("--- Stage 1: Initializing Playwright and Harvesting Credentials ---")
         playwright = await async_playwright().start()
-        browser = await playwright.chromium.launch(headless=True)
-        context = await browser.new_context(user_agent=user_agent)
-        page = await context.new_page()
-        await stealth_async(page)
-        
-        print("  Navigating to the chart page...")
-        await page.goto(chart_page_url, wait_until="domcontentloaded", timeout=60000)
-
-        print("  Waiting for application state (App.stk)...")
-        await page.wait_for_function("() => typeof window.App !== 'undefined' && typeof window.App.stk === 'string'", timeout=30000)
-        
-        bearer_token = await page.evaluate("() => window.App.stk")
-        cookies = await context.cookies()
-        cookie_string = "; ".join([f"{cookie['name']}={cookie['value']}" for cookie in cookies])
-
-        if not bearer_token or not cookies:
-            raise Exception("Failed to harvest a bearer token or cookies.")
-
-        print("  ✓ Credentials Harvested Successfully!")
-
-        # --- PART 2: Make a direct API call ---
-        print("\n--- Stage 2: Making Direct API Call with CloudScraper ---")
-        
-        headers = {
-            'Accept': '*/*',
-            'Authorization': f'Bearer {bearer_token}',
-            'Cookie': cookie_string,
-            'Referer': chart_page_url,
-            'User-Agent': user_agent
-        }
-        
-        # KEY CHANGE: Initialize cloudscraper right after getting credentials,
-        # mimicking a tighter "session" link.
-        scraper = cloudscraper.create_scraper()
-        
-        print(f"  Sending GET request to: {data_api_url}")
-        response = scraper.get(data_api_url, headers=headers)
-        response.raise_for_status()
+        context, page = await launch_browser(playwright)
+        bearer_token, cookies, user_agent = await harvest_credentials(page)
 
-        print(f"  ✓ API Call Success! Server responded with Status Code: {response.status_code}")
-        
-        api_data = response.json()
-        
-        # --- PART 3: Process and Store Data ---
-        process_and_store_data(api_data)
+        # The browser is no longer needed: shut it down in the background while the API call runs
+        browser_closing = asyncio.create_task(context.close())
+        await save_cached_credentials(bearer_token, cookies, user_agent, _credentials_expiry(cookies))
 
-        print("\nScript finished successfully.")
+        await _fetch_and_store(bearer_token, cookies, user_agent)
+        log.info("Script finished successfully.")
 
     except Exception as e:
-        print(f"\n--- AN UNHANDLED ERROR OCCURRED ---")
-        print(f"  {type(e).__name__}: {e}")
-        if 'response' in locals():
-            print("  Server response text:", response.text[:500])
+        log.error("--- AN UNHANDLED ERROR OCCURRED ---")
+        log.error("  %s: %s", type(e).__name__, e)
 
     finally:
         # Graceful cleanup of Playwright
         if playwright:
-            print("  Closing Playwright.")
+            log.info("  Closing Playwright.")
+            if browser_closing is not None:
+                await asyncio.gather(browser_closing, return_exceptions=True)
             await playwright.stop()
 
+
+async def run_forever():
+    """Long-running worker: keeps one browser and one API session warm and runs the fetch/store cycle every RUN_INTERVAL_SECONDS.
+    Credentials are only re-harvested when they expire (see _credentials_expiry) or the API rejects them, never because of
+    an unrelated failure such as a DynamoDB throttle; a browser that fails during a harvest is discarded and relaunched on
+    the next one. The browser is not even started while cached credentials from a previous task are still valid."""
+    log.info("Starting MacroMicro OIS Hijacker worker (every %ds)...", RUN_INTERVAL_SECONDS)
+
+    playwright = await async_playwright().start()
+    context = page = api_session = None
+    expires_at = float('-inf')
+    try:
+        cached = await load_cached_credentials()
+        if cached is not None:
+            log.info("  Reusing cached credentials.")
+            bearer_token, cookies, user_agent, expires_at = cached
+            api_session = open_api_session(bearer_token, cookies, user_agent)
+
+        async def refresh_credentials():
+            nonlocal context, page, api_session, expires_at
+            log.info("--- Stage 1: Harvesting Credentials ---")
+            try:
+                if context is None:
+                    context, page = await launch_browser(playwright)
+                elif time.time() >= expires_at:
+                    # The persistent profile would hand the stale cf_clearance straight back; drop all cookies so
+                    # the harvest goes through a fresh Cloudflare check instead
+                    log.info("  Credentials expired, clearing the browser's cookies before harvesting...")
+                    await context.clear_cookies()
+                bearer_token, cookies, user_agent = await harvest_credentials(page)
+            except Exception:
+                # The browser may have crashed or wedged: drop it so the next harvest launches a new one
+                if context is not None:
+                    with contextlib.suppress(Exception):
+                        await asyncio.wait_for(context.close(), 10)
+                context = page = None
+                raise
+            # Build the new session before retiring the old one, so a failure here leaves the previous credentials usable
+            new_session = open_api_session(bearer_token, cookies, user_agent)
+            old_session, api_session = api_session, new_session
+            expires_at = _credentials_expiry(cookies)
+            if old_session is not None:
+                await old_session.close()
+            await save_cached_credentials(bearer_token, cookies, user_agent, expires_at)
+
+            # Park the page so the site's scripts don't keep running for hours until the next harvest
+            try:
+                await page.goto("about:blank")
+            except Exception as e:
+                log.warning("  Could not park the browser page (%s: %s).", type(e).__name__, e)
+
+        loop = asyncio.get_running_loop()
+        next_run = loop.time()
+        while True:
+            await asyncio.sleep(max(0.0, next_run - loop.time()))
+            next_run = loop.time() + RUN_INTERVAL_SECONDS
+
+            try:
+                if api_session is None or time.time() >= expires_at:
+                    await refresh_credentials()
+
+                log.info("--- Stage 2: Making Direct API Call with aiohttp ---")
+                try:
+                    async with fetch_data_with_credentials(api_session) as series_stream:
+                        await process_and_store_data(series_stream)
+                except Exception as e:
+                    if not _is_auth_error(e):
+                        raise
+                    log.warning("  Credentials rejected, re-harvesting...")
+                    await refresh_credentials()
+                    async with fetch_data_with_credentials(api_session) as series_stream:
+                        await process_and_store_data(series_stream)
+                log.info("Run finished successfully.")
+
+            except Exception as e:
+                log.error("--- AN ERROR OCCURRED DURING THIS RUN ---")
+                log.error("  %s: %s", type(e).__name__, e)
+    finally:
+        if api_session is not None:
+            await api_session.close()
+        log.info("  Closing Playwright.")
+        await playwright.stop()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'), format='%(message)s')
+    # `--once` keeps the original one-shot behaviour (e.g. for scheduled ECS tasks).
+    asyncio.run(main() if '--once' in sys.argv[1:] else run_forever())